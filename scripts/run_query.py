@@ -1,25 +1,57 @@
 #!/usr/bin/env python3
+import asyncio
+import http.client
 import json
 import os
 import random
-import re
-import subprocess
+import sqlite3
 import sys
+import threading
 from datetime import datetime, timezone
 from pathlib import Path
+from urllib.parse import urlsplit
 import hashlib
+import itertools
+import operator
+import string
+from math import prod
+
+try:
+    import orjson
+except ImportError:  # optional speedup; stdlib json is the fallback for anything it rejects
+    orjson = None
 
 # -------------------------
 # Config (env-overridable)
 # -------------------------
+
+def _positive_int_env(name: str, default: str) -> int:
+    value = int(os.environ.get(name, default))
+    if value < 1:
+        raise ValueError(f"{name} must be at least 1, got {value}")
+    return value
+
+
 MODEL = os.environ.get("OLLAMA_MODEL", "mistral")  # e.g. mistral, llama3, phi3, qwen, etc.
 MAX_TOKENS = int(os.environ.get("OLLAMA_MAX_TOKENS", "0"))  # 0 lets model default
 TEMPERATURE = os.environ.get("OLLAMA_TEMPERATURE", "0.2")
+NUM_CTX = int(os.environ.get("OLLAMA_NUM_CTX", "4096"))
+OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://localhost:11434")
+BATCH_SIZE = _positive_int_env("BATCH", "32")  # topics generated per invocation
+# In-flight requests; matching the server's OLLAMA_NUM_PARALLEL keeps every slot busy
+CONCURRENCY = _positive_int_env("CONCURRENCY" if "CONCURRENCY" in os.environ else "OLLAMA_NUM_PARALLEL", "4")
 OUTPUT_DIR = Path(os.environ.get("OUTPUT_DIR", "outputs"))
 STATE_DIR = Path(os.environ.get("STATE_DIR", "state"))
 STATE_DIR.mkdir(parents=True, exist_ok=True)
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 INDEX_PATH = STATE_DIR / "last_index.txt"
+FAILED_PATH = STATE_DIR / "failed.jsonl"  # claimed topics whose generation failed, for retry
+SHARD_SIZE = 1000  # records per outputs/shard-NNNNNNNN.jsonl, by topic index
+# topic_index -> shard offset lookup; derived from the shards, so it is rebuilt rather than committed
+SHARD_INDEX_PATH = STATE_DIR / "shard_index.sqlite"
+CACHE_DIR = STATE_DIR / "cache"
+# Only near-deterministic generations are worth replaying from disk
+CACHE_ENABLED = os.environ.get("CACHE_ENABLED", "0") == "1" and float(TEMPERATURE) <= 0.3
 
 # -------------------------
 # Topic Space (Python 3.12+)
@@ -27,7 +59,7 @@ INDEX_PATH = STATE_DIR / "last_index.txt"
 # We build a very large *implicit* topic space via combinatorics without storing it all at once.
 # The generator maps an integer index -> a deterministic topic string.
 
-CORE_CONCEPTS = [
+CORE_CONCEPTS = tuple(sys.intern(s) for s in [
     "pattern matching (match/case)",
     "structural pattern matching guards",
     "f-strings formalization (PEP 701)",
@@ -53,17 +85,17 @@ CORE_CONCEPTS = [
     "datetime and timezone correctness",
     "decimal vs float precision",
     "copy vs deepcopy semantics",
-]
+])
 
 # Pull stdlib module names from the running interpreter where available.
 try:
     import sys as _sys
-    STDLIB_MODULES = sorted(getattr(_sys, "stdlib_module_names", set()))
+    STDLIB_MODULES = tuple(sys.intern(m) for m in sorted(getattr(_sys, "stdlib_module_names", set())))
 except Exception:
-    STDLIB_MODULES = []
+    STDLIB_MODULES = ()
 
 # Curated popular third‑party libs frequently used with Python 3.12+
-THIRDPARTY = [
+THIRDPARTY = tuple(sys.intern(s) for s in [
     "fastapi", "pydantic", "sqlalchemy", "alembic", "psycopg", "httpx",
     "requests", "uvicorn", "gunicorn", "pytest", "hypothesis", "mypy",
     "pyright", "ruff", "black", "isort", "poetry", "pip-tools", "pipx",
@@ -72,90 +104,276 @@ THIRDPARTY = [
     "celery", "redis", "kombu", "aiohttp", "trio", "anyio", "typer",
     "click", "rich", "loguru", "tenacity", "orjson", "uvloop", "asyncpg",
     "motor", "pymongo", "boto3", "azure-identity", "google-cloud-storage",
-]
+])
 
-ACTIONS = [
+ACTIONS = tuple(sys.intern(s) for s in [
     "design", "implement", "refactor", "optimize", "benchmark", "profile",
     "unit test", "property test", "type-check", "document", "package",
     "containerize", "deploy", "secure", "harden", "observe",
-]
+])
 
-DOMAINS = [
+DOMAINS = tuple(sys.intern(s) for s in [
     "CLI tools", "REST APIs", "web backends", "data pipelines", "ETL jobs",
     "stream processing", "microservices", "batch jobs", "ML training loops",
     "notebooks to production", "event-driven systems", "cron-driven tasks",
     "serverless handlers", "WASM targets", "edge runtimes",
-]
+])
 
-ADV_TOPICS = [
+ADV_TOPICS = tuple(sys.intern(s) for s in [
     "zero-copy buffers", "memoryview techniques", "Cython vs CFFI vs ctypes",
     "multiprocessing vs asyncio for I/O", "threadpools and GIL behavior",
     "structured logging", "backpressure in async code", "cancellation safety",
     "retry policies and idempotency", "schema validation",
     "ORM performance patterns", "vectorized computing", "columnar data (Arrow)",
     "time-series indexing", "TZ-aware datetimes", "parsing and lexing",
-]
+])
 
-TEMPLATES = [
+TEMPLATES = tuple(sys.intern(s) for s in [
     "How to {action} {domain} using {lib} with Python 3.12+",
     "Deep dive: {concept} with {lib} in Python 3.12+",
     "Best practices to {action} {lib} for {domain} (Python 3.12+)",
     "{concept} — pitfalls and patterns in {domain} (Python 3.12+)",
     "Performance guide: {adv} with {lib} on Python 3.12+",
-]
+])
 
 # Mixed‑radix mapping of a single integer -> a tuple of indices into the arrays above
-SPACE = [ACTIONS, DOMAINS, CORE_CONCEPTS, THIRDPARTY, ADV_TOPICS, TEMPLATES]
-RADIX = [len(ACTIONS), len(DOMAINS), len(CORE_CONCEPTS), len(THIRDPARTY), len(ADV_TOPICS), len(TEMPLATES)]
-TOTAL_SPACE = 1
-for r in RADIX:
-    TOTAL_SPACE *= r
+# (tuples of interned strings: fixed-size, shared, and cheap to hash as format values)
+SPACE = (ACTIONS, DOMAINS, CORE_CONCEPTS, THIRDPARTY, ADV_TOPICS, TEMPLATES)
+RADIX = tuple(map(len, SPACE))
+TOTAL_SPACE = prod(RADIX)
+# Place value of each digit: field k of a combo index is (cidx // DIVISORS[k]) % RADIX[k]
+DIVISORS = tuple(itertools.accumulate(RADIX, operator.mul, initial=1))[:-1]
 
 # Expand with stdlib-only templates for even more coverage without exploding memory
-STDLIB_TEMPLATES = [
+STDLIB_TEMPLATES = tuple(sys.intern(s) for s in [
     "Deep dive: {module} standard library module in Python 3.12+",
     "{module}: common mistakes, gotchas, and best practices (Python 3.12+)",
     "How to combine {module} with typing for production code (Python 3.12+)",
     "Testing strategies for {module} code with pytest (Python 3.12+)",
-]
+])
 TOTAL_STDLIB = len(STDLIB_MODULES) * len(STDLIB_TEMPLATES) if STDLIB_MODULES else 0
 
+# Generation budget (num_predict) per template. Sized with headroom over observed replies
+# (~500 tokens median, ~900 max) since a truncated reply is invalid JSON.
+EST_TOKENS = {
+    TEMPLATES[0]: 1024,
+    TEMPLATES[1]: 1536,
+    TEMPLATES[2]: 1280,
+    TEMPLATES[3]: 1280,
+    TEMPLATES[4]: 1536,
+    STDLIB_TEMPLATES[0]: 1024,
+    STDLIB_TEMPLATES[1]: 1024,
+    STDLIB_TEMPLATES[2]: 1024,
+    STDLIB_TEMPLATES[3]: 1280,
+}
+
+# Templates pre-split into (literal, field) pairs so rendering never re-tokenizes them
+_PLANS = {
+    t: tuple((literal, field) for literal, field, _, _ in string.Formatter().parse(t))
+    for t in (*TEMPLATES, *STDLIB_TEMPLATES)
+}
+
+
+def render(template: str, data: dict[str, str]) -> str:
+    parts = []
+    for literal, field in _PLANS[template]:
+        parts.append(literal)
+        if field:
+            parts.append(str(data[field]))
+    return "".join(parts)
+
+
+def _mk_combo_decoder():
+    """Decoder for an offset into the combo space, with its tables bound as closure locals."""
+    fields = tuple(zip(DIVISORS, RADIX))
+    actions, domains, concepts, libs, advs, templates = SPACE
+
+    def decode_combo(cidx: int) -> tuple[str, dict[str, str]]:
+        a, d, c, l, adv, t = [(cidx // div) % r for div, r in fields]
+        return templates[t], {
+            "action": actions[a],
+            "domain": domains[d],
+            "concept": concepts[c],
+            "lib": libs[l],
+            "adv": advs[adv],
+        }
+
+    return decode_combo
+
+
+def _mk_interleaved(decode_combo):
+    modules, stdlib_templates = STDLIB_MODULES, STDLIB_TEMPLATES
+    n_modules, n_templates = len(STDLIB_MODULES), len(STDLIB_TEMPLATES)
+    total_stdlib, total_space = TOTAL_STDLIB, TOTAL_SPACE
+
+    def decode_index(idx: int) -> tuple[str, dict[str, str]]:
+        """The (template, field values) that topic index `idx` renders to."""
+        # Interleave between combo-space and stdlib-space to diversify
+        # Even idx -> combo; odd idx -> stdlib
+        if idx & 1:
+            sidx = (idx >> 1) % total_stdlib
+            return stdlib_templates[(sidx // n_modules) % n_templates], {"module": modules[sidx % n_modules]}
+        return decode_combo((idx >> 1) % total_space)
+
+    return decode_index
+
+
+def _mk_combo_only(decode_combo):
+    total_space = TOTAL_SPACE
+
+    def decode_index(idx: int) -> tuple[str, dict[str, str]]:
+        """The (template, field values) that topic index `idx` renders to."""
+        # No stdlib module names on this interpreter: every index is a combo topic
+        return decode_combo(idx % total_space)
+
+    return decode_index
+
+
+# Whether stdlib names are available is fixed per interpreter, so pick the decoder once
+decode_index = (_mk_interleaved if TOTAL_STDLIB else _mk_combo_only)(_mk_combo_decoder())
+
 
 def index_to_topic(idx: int) -> str:
     """Map an integer to a deterministic topic string spanning huge space."""
-    # Interleave between combo-space and stdlib-space to diversify
-    # Even idx -> combo; odd idx -> stdlib (if available), fallback to combo
-    if (idx % 2 == 1) and TOTAL_STDLIB:
-        sidx = (idx // 2) % TOTAL_STDLIB
-        mod_idx = sidx % len(STDLIB_MODULES)
-        tmpl_idx = (sidx // len(STDLIB_MODULES)) % len(STDLIB_TEMPLATES)
-        module = STDLIB_MODULES[mod_idx]
-        tmpl = STDLIB_TEMPLATES[tmpl_idx]
-        return tmpl.format(module=module)
-
-    # combo space
-    cidx = (idx // 2) % TOTAL_SPACE if TOTAL_STDLIB else idx % TOTAL_SPACE
-    a = cidx % RADIX[0]
-    cidx //= RADIX[0]
-    d = cidx % RADIX[1]
-    cidx //= RADIX[1]
-    c = cidx % RADIX[2]
-    cidx //= RADIX[2]
-    l = cidx % RADIX[3]
-    cidx //= RADIX[3]
-    adv = cidx % RADIX[4]
-    cidx //= RADIX[4]
-    t = cidx % RADIX[5]
-
-    data = {
-        "action": ACTIONS[a],
-        "domain": DOMAINS[d],
-        "concept": CORE_CONCEPTS[c],
-        "lib": THIRDPARTY[l],
-        "adv": ADV_TOPICS[adv],
-    }
-    template = TEMPLATES[t]
-    return template.format(**data)
+    return render(*decode_index(idx))
+
+
+def template_of(idx: int) -> str:
+    """The template index_to_topic(idx) fills in."""
+    return decode_index(idx)[0]
+
+
+def bucket_by_length(indices: list[int]) -> list[tuple[int, list[int]]]:
+    """Group indices by expected reply length; returns (num_predict cap, indices) per bucket."""
+    budget = {i: EST_TOKENS[template_of(i)] for i in indices}
+    buckets = []
+    for cap, group in itertools.groupby(sorted(indices, key=budget.__getitem__), key=budget.__getitem__):
+        # OLLAMA_MAX_TOKENS, when set, stays a hard ceiling
+        buckets.append((min(cap, MAX_TOKENS) if MAX_TOKENS else cap, list(group)))
+    return buckets
+
+
+def indices_to_topics(idxs: list[int]) -> list[str]:
+    """Batch form of index_to_topic."""
+    return [render(*decode_index(idx)) for idx in idxs]
+
+
+# -------------------------
+# Atomic file writes
+# -------------------------
+
+def atomic_write_bytes(path: Path, data: bytes, fsync: bool = True) -> None:
+    """Replace `path` with `data` so readers (and crashes) only ever see the old or new contents."""
+    tmp = path.with_suffix(f"{path.suffix}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with tmp.open("wb") as f:
+        f.write(data)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def atomic_write_text(path: Path, data: str, fsync: bool = True) -> None:
+    atomic_write_bytes(path, data.encode("utf-8"), fsync)
+
+
+def dump_json(obj) -> bytes:
+    """Compact UTF-8 JSON, via orjson when it is installed."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            pass  # e.g. integers wider than 64 bits, which only the stdlib encoder handles
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+# -------------------------
+# Record shards
+# -------------------------
+
+class ShardStore:
+    """Append-only JSONL shards in OUTPUT_DIR, indexed by a sqlite file in STATE_DIR.
+
+    The index maps topic_index -> (shard, byte_offset, length) for random access. It holds
+    nothing the shards don't, so a missing index is rebuilt by scanning them.
+    """
+
+    def __init__(self, output_dir: Path = OUTPUT_DIR, index_path: Path = SHARD_INDEX_PATH):
+        self.output_dir = output_dir
+        self.files = {}
+        rebuild = not index_path.exists()
+        self.db = sqlite3.connect(index_path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            " topic_index INTEGER PRIMARY KEY,"
+            " shard TEXT NOT NULL,"
+            " byte_offset INTEGER NOT NULL,"
+            " length INTEGER NOT NULL)"
+        )
+        self.db.commit()
+        if rebuild:
+            self.rebuild()
+
+    def rebuild(self) -> None:
+        """Re-index every complete line of every shard; later lines win for a repeated topic_index."""
+        rows = []
+        for path in sorted(self.output_dir.glob("shard-*.jsonl")):
+            offset = 0
+            with path.open("rb") as f:
+                for line in f:
+                    data = line.rstrip(b"\n")
+                    try:
+                        idx = json.loads(data)["topic_index"] if line.endswith(b"\n") else None
+                    except (ValueError, KeyError, TypeError):
+                        idx = None  # torn tail left by a crash mid-append
+                    if idx is not None:
+                        rows.append((idx, path.name, offset, len(data)))
+                    offset += len(line)
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO records (topic_index, shard, byte_offset, length) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, record: dict) -> tuple[str, int, int]:
+        shard = f"shard-{record['topic_index'] // SHARD_SIZE:08d}.jsonl"
+        f = self.files.get(shard)
+        if f is None:
+            path = self.output_dir / shard
+            f = self.files[shard] = path.open("ab")
+            if f.seek(0, os.SEEK_END):
+                # Terminate a torn tail from an earlier crash so this record starts on its own line
+                with path.open("rb") as tail:
+                    tail.seek(-1, os.SEEK_END)
+                    if tail.read(1) != b"\n":
+                        f.write(b"\n")
+        data = dump_json(record)
+        offset = f.seek(0, os.SEEK_END)
+        f.write(data + b"\n")
+        # Records arrive seconds apart, so sync each one: the shard bytes are durable before the
+        # index row pointing at them is committed, and the write lock on the index is held
+        # only for this one-row transaction rather than the whole batch
+        f.flush()
+        os.fsync(f.fileno())
+        loc = (shard, offset, len(data))
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO records (topic_index, shard, byte_offset, length) VALUES (?, ?, ?, ?)",
+                (record["topic_index"], *loc),
+            )
+        return loc
+
+    def close(self) -> None:
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+        self.db.close()
 
 
 # -------------------------
@@ -172,106 +390,252 @@ def read_index() -> int:
 
 
 def write_index(i: int) -> None:
-    INDEX_PATH.write_text(str(i))
+    atomic_write_text(INDEX_PATH, str(i))
+
+
+def claim_range(n: int) -> range:
+    """Reserve the next `n` topic indices with a single atomic write, before any work starts.
+
+    This is not a lock: processes reading the same last_index.txt (e.g. two checkouts of one
+    commit) claim the same range, so concurrent collectors must be serialized by the caller.
+    """
+    idx = read_index()
+    write_index(idx + n)
+    return range(idx, idx + n)
+
+
+def log_failures(failures: list[tuple[int, Exception | str]]) -> None:
+    if not failures:
+        return
+    ts = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    lines = b"".join(
+        dump_json({"timestamp_utc": ts, "topic_index": i, "error": str(err)}) + b"\n"
+        for i, err in sorted(failures, key=lambda f: f[0])
+    )
+    with FAILED_PATH.open("ab") as f:
+        f.write(lines)
+
+
+# -------------------------
+# Response cache
+# -------------------------
+
+def cache_path(request: dict) -> Path:
+    # Keyed on everything that shapes the reply: model, prompt, schema and all options
+    key = hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+    return CACHE_DIR / key[:2] / key
+
+
+def cache_get(request: dict) -> str | None:
+    try:
+        return cache_path(request).read_text(encoding="utf-8")
+    except FileNotFoundError:
+        return None
+
+
+def cache_put(request: dict, response: str) -> None:
+    path = cache_path(request)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # A lost cache entry is only a re-generation, so skip the fsync
+    atomic_write_text(path, response, fsync=False)
 
 
 # -------------------------
 # Ollama invocation
 # -------------------------
 
-def call_ollama(prompt: str) -> str:
-    # Compose full prompt to nudge JSON output
-    system_instructions = (
-        "You are a meticulous Python 3.12+ expert. "
-        "Return a concise but thorough JSON object with keys: "
-        "title, summary, key_points (list), code_examples (list of objects with language and code), "
-        "version_notes (list), caveats (list). Use only valid JSON."
-    )
-    full_prompt = f"{system_instructions}\n\nTOPIC:\n{prompt}"
+# One keep-alive connection per worker thread (http.client connections are not thread-safe)
+_OLLAMA = urlsplit(OLLAMA_URL)
+_local = threading.local()
 
-    cmd = ["ollama", "run", MODEL]
-    env = os.environ.copy()
-    env["OLLAMA_NUM_CTX"] = env.get("OLLAMA_NUM_CTX", "4096")
-    if MAX_TOKENS:
-        env["OLLAMA_NUM_PREDICT"] = str(MAX_TOKENS)
-    env["OLLAMA_TEMPERATURE"] = str(TEMPERATURE)
-
-    proc = subprocess.run(
-        cmd,
-        input=full_prompt,
-        text=True,
-        capture_output=True,
-        env=env,
-        check=False,
-    )
 
-    stdout = proc.stdout.strip()
-    stderr = proc.stderr.strip()
-    if proc.returncode != 0:
-        raise RuntimeError(f"ollama failed: {proc.returncode}\n{stderr}\n{stdout}")
-    return stdout
+def _connection() -> http.client.HTTPConnection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        cls = http.client.HTTPSConnection if _OLLAMA.scheme == "https" else http.client.HTTPConnection
+        conn = _local.conn = cls(_OLLAMA.hostname, _OLLAMA.port)
+    return conn
+
+
+def _post_json(path: str, payload: dict) -> dict:
+    body = json.dumps(payload).encode("utf-8")
+    url = _OLLAMA.path.rstrip("/") + path
+    for attempt in range(2):
+        conn = _connection()
+        try:
+            conn.request("POST", url, body=body, headers={"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            data = resp.read()
+        except (OSError, http.client.HTTPException) as e:
+            # Never reuse a connection left mid-request; the next call starts fresh
+            conn.close()
+            _local.conn = None
+            # The server may drop an idle keep-alive connection; only that is retried
+            idle_drop = isinstance(e, (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError))
+            if attempt or not idle_drop:
+                raise
+            continue
+        if resp.status != 200:
+            raise RuntimeError(f"ollama failed: HTTP {resp.status}\n{data.decode('utf-8', 'replace')}")
+        return json.loads(data)
+
+
+# Generation options fixed for the whole run; only num_predict varies per request
+_BASE_OPTIONS = {"temperature": float(TEMPERATURE), "num_ctx": NUM_CTX}
+
+# Structured-output schema: Ollama constrains decoding so the response is always this JSON shape
+_STR_LIST = {"type": "array", "items": {"type": "string"}}
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title": {"type": "string"},
+        "summary": {"type": "string"},
+        "key_points": _STR_LIST,
+        "code_examples": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"language": {"type": "string"}, "code": {"type": "string"}},
+                "required": ["language", "code"],
+            },
+        },
+        "version_notes": _STR_LIST,
+        "caveats": _STR_LIST,
+    },
+    "required": ["title", "summary", "key_points", "code_examples", "version_notes", "caveats"],
+}
+
+
+def call_ollama(prompt: str, num_predict: int = MAX_TOKENS or -1) -> str:
+    # The schema enforces structure; a one-line hint keeps the content on target
+    system_instructions = "You are a meticulous Python 3.12+ expert. Answer as a concise but thorough JSON object."
+    full_prompt = f"{system_instructions}\n\nTOPIC:\n{prompt}"
+
+    for attempt in range(2):
+        request = {
+            "model": MODEL,
+            "prompt": full_prompt,
+            "format": RESPONSE_SCHEMA,
+            "options": {**_BASE_OPTIONS, "num_predict": num_predict},
+        }
+        if CACHE_ENABLED and (cached := cache_get(request)) is not None:
+            return cached
+
+        body = _post_json("/api/generate", {
+            **request,
+            "stream": False,
+            "keep_alive": "30m",  # keep the model resident between requests and runs
+        })
+        response = body["response"].strip()
+        if body.get("done_reason") != "length":
+            break
+        # Cut off by the bucket's cap: retry once with twice the budget (OLLAMA_MAX_TOKENS still
+        # caps it); a reply that is still truncated is a failure, not a record
+        retry_cap = min(num_predict * 2, MAX_TOKENS) if MAX_TOKENS else num_predict * 2
+        if attempt or retry_cap <= num_predict:
+            raise RuntimeError(f"ollama reply truncated at num_predict={num_predict}")
+        num_predict = retry_cap
+
+    # Never replay a reply that is not valid JSON
+    if CACHE_ENABLED and try_parse_json(response) is not None:
+        cache_put(request, response)
+    return response
+
+
+async def generate(
+    sem: asyncio.Semaphore, idx: int, prompt: str, num_predict: int
+) -> tuple[int, str | None, Exception | None]:
+    """Run one generation under the concurrency limit; returns (idx, response, error)."""
+    async with sem:
+        try:
+            return idx, await asyncio.to_thread(call_ollama, prompt, num_predict), None
+        except Exception as e:
+            return idx, None, e
 
 
 # -------------------------
 # JSON robustness
 # -------------------------
 
+_DECODER = json.JSONDecoder()
+
+
 def try_parse_json(s: str):
-    # Try whole string, then first JSON object via a lax extractor
+    # Output is schema-constrained, so the whole reply normally parses as-is
     try:
         return json.loads(s)
-    except Exception:
+    except ValueError:
         pass
-    # Find first \{...\} block
-    m = re.search(r"\{[\s\S]*\}", s)
-    if m:
-        try:
-            return json.loads(m.group(0))
-        except Exception:
-            return None
-    return None
+    # Servers without structured-output support may wrap the object in prose; decode from the
+    # first "{" in one linear pass (no regex backtracking) and ignore any trailing text
+    start = s.find("{")
+    if start < 0:
+        return None
+    try:
+        return _DECODER.raw_decode(s, start)[0]
+    except ValueError:
+        return None
 
 
 # -------------------------
 # Main
 # -------------------------
 
-def main():
-    idx = read_index()
-    topic = index_to_topic(idx)
-
-    # Prepare metadata
-    ts = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
-    prompt = f"Write a Python 3.12+ focused, accurate explainer for: {topic}"
-
-    try:
-        raw = call_ollama(prompt)
-    except Exception as e:
-        raw = f"ERROR calling ollama: {e}"
-
-    parsed = try_parse_json(raw)
-
+def save_record(store: ShardStore, idx: int, topic: str, prompt: str, raw: str) -> str:
     record = {
-        "timestamp_utc": ts,
+        "timestamp_utc": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
         "model": MODEL,
         "topic_index": idx,
         "topic": topic,
         "prompt": prompt,
         "response_raw": raw,
-        "response_parsed": parsed,
+        "response_parsed": try_parse_json(raw),
     }
-
-    # Stable filename from topic index + short hash of topic text
-    short = hashlib.sha256(topic.encode("utf-8")).hexdigest()[:10]
-    fname = f"{ts.replace(':','').replace('-','')}__{idx:012d}_{short}.json"
-    out_path = OUTPUT_DIR / fname
-    with out_path.open("w", encoding="utf-8") as f:
-        json.dump(record, f, indent=2, ensure_ascii=False)
-
-    print(f"Saved {out_path}")
-
-    # advance pointer and persist
-    write_index(idx + 1)
+    shard, offset, _ = store.append(record)
+    return f"{shard}@{offset}"
+
+
+async def amain(batch_size: int = BATCH_SIZE):
+    # The counter moves past the whole batch up front, so a crash in this process leaves gaps
+    # (indices missing from the shard index) rather than re-running the same topics on restart
+    indices = list(claim_range(batch_size))
+    topics = dict(zip(indices, indices_to_topics(indices)))
+    prompts = {i: f"Write a Python 3.12+ focused, accurate explainer for: {t}" for i, t in topics.items()}
+
+    sem = asyncio.Semaphore(CONCURRENCY)
+    # Tasks take semaphore slots in creation order, so requests running side by side on
+    # the server come from the same length bucket and get a tight num_predict
+    tasks = [
+        asyncio.create_task(generate(sem, i, prompts[i], cap))
+        for cap, bucket in bucket_by_length(indices)
+        for i in bucket
+    ]
+    failures = []
+    saved = set()
+    try:
+        with ShardStore() as store:
+            # Save each record as soon as it lands so one slow generation doesn't hold back the rest
+            for fut in asyncio.as_completed(tasks):
+                i, raw, err = await fut
+                if err is None:
+                    try:
+                        print(f"Saved topic {i} to {save_record(store, i, topics[i], prompts[i], raw)}")
+                        saved.add(i)
+                        continue
+                    except Exception as e:
+                        err = e
+                print(f"Failed topic {i}: {err}", file=sys.stderr)
+                failures.append((i, err))
+    finally:
+        # Failed topics stay claimed; they are recorded for a later retry instead of rolling back.
+        # If the run is aborted, whatever it claimed but never finished is recorded as well.
+        failed = {i for i, _ in failures}
+        failures += [(i, "run aborted before completion") for i in indices if i not in saved and i not in failed]
+        log_failures(failures)
+
+
+def main(batch_size: int = BATCH_SIZE):
+    asyncio.run(amain(batch_size))
 
 
 if __name__ == "__main__":